@@ -1,15 +1,86 @@
-from BitHash import BitHash as BH
-from BitVector import BitVector as BV
+from concurrent.futures import ThreadPoolExecutor
+from xxhash import xxh3_64_intdigest
+from numba import njit
+import numpy as np
 import math
+import mmap
+import os
+
+
+#seed for the second base hash stream - any fixed constant distinct
+#from the first stream's seed works; this is 2^64 over the golden ratio
+SEED2 = 0x9E3779B97F4A7C15
+
+#how many threads the batch paths may spread a large batch over, and
+#the batch size below which threading overhead outweighs the win
+NUM_THREADS = os.cpu_count() or 1
+MIN_PARALLEL = 1 << 15
+
+
+# The per-key probe loops live in Numba-compiled kernels so that the
+# hot path runs as machine code over the block array, with no Python
+# objects involved. All arithmetic is kept in uint64 to match the
+# block array's dtype.
+#
+# The kernels are built per filter: numBlocks and numHashes are fixed
+# at construction time, so they're closed over as compile-time
+# constants rather than passed as arguments. Numba then folds the
+# block arithmetic and unrolls the constant-count probe loop instead
+# of re-reading the geometry on every call.
+def _makeKernels(numBlocks, numHashes):
+
+    nb = np.uint64(numBlocks)
+
+    @njit
+    def insertKernel(blocks, h1, h2):
+        blk = ((h1 >> np.uint64(32)) * nb) >> np.uint64(32)
+        for i in range(numHashes):
+            pos = (h1 + np.uint64(i) * h2) & np.uint64(255)
+            w = pos >> np.uint64(6)
+            blocks[blk, w] |= np.uint64(1) << (pos & np.uint64(63))
+
+    # probe lazily, one bit at a time - each probe only needs the two
+    # base hashes, so an absent key exits on its first cleared bit
+    # without paying for the remaining probes
+    @njit
+    def findKernel(blocks, h1, h2):
+        blk = ((h1 >> np.uint64(32)) * nb) >> np.uint64(32)
+        for i in range(numHashes):
+            pos = (h1 + np.uint64(i) * h2) & np.uint64(255)
+            bit = np.uint64(1) << (pos & np.uint64(63))
+            if not blocks[blk, pos >> np.uint64(6)] & bit:
+                return False
+        return True
+
+    # batch counterparts: one fused machine-code loop over the keys'
+    # base hashes, with nogil so independent batches can run in
+    # parallel on plain Python threads
+    @njit(nogil=True)
+    def insertManyKernel(blocks, h1, h2):
+        for k in range(h1.shape[0]):
+            insertKernel(blocks, h1[k], h2[k])
+
+    @njit(nogil=True)
+    def findManyKernel(blocks, h1, h2, out):
+        for k in range(h1.shape[0]):
+            out[k] = findKernel(blocks, h1[k], h2[k])
+
+    return insertKernel, findKernel, insertManyKernel, findManyKernel
+
 
 class BloomFilter(object):
     
-    def __bitsNeeded(self, numKeys, numHashes, maxFalsePositive):
-        
-        #use equation to calculate the number of bits needed to avoid
-        #more false positives than the maximum allowed
-        phi = 1-(maxFalsePositive)**(1/numHashes)
-        return math.ceil((numHashes)/(1-phi**(1/numKeys)))
+    def __bitsNeeded(self, numKeys, maxFalsePositive):
+
+        #closed form for the optimal filter size, N = -n ln(P) / (ln 2)^2
+        #- one log call, where the old rearrangement took two pow calls
+        #with fractional exponents that lose precision for large numKeys
+        base = math.ceil(-numKeys * math.log(maxFalsePositive)
+                         / (math.log(2) ** 2))
+
+        #round up to a power of two so probe indices can be computed
+        #with a single AND instead of a 64 bit modulo
+        return 1 << math.ceil(math.log2(base))
         
     
     # Creates a Bloom Filter that will store numKeys keys, using 
@@ -26,64 +97,171 @@ class BloomFilter(object):
         
         #use the __bitsNeeded()  method to calculate how many bits long the 
         #bit vector should be
-        self.__N=self.__bitsNeeded(self.__numKeys, self.__numHashes,\
-                                   self.__maxFalsePos)
-        
-        #initialize a bit vector of the needed size
-        self.__bitVector = BV(size=(self.__N))
-        
-        #keep track of how many bits are set to 1
-        self.__numBits=0
+        self.__N=self.__bitsNeeded(self.__numKeys, self.__maxFalsePos)
+
+        #split the bits into 256 bit blocks (4 words = one cache line),
+        #and put all of a key's probes inside a single block, so a find
+        #touches one cache line instead of numHashes scattered ones
+        self.__numBlocks = max(1, self.__N >> 8)
+        self.__N = self.__numBlocks << 8
+
+        #allocate the blocks 64 byte aligned, so each block really does
+        #sit in a single cache line - numpy only guarantees 16 byte
+        #alignment, and a straddling block would cost two lines per probe
+        buf = np.zeros(self.__numBlocks * 4 + 8, dtype=np.uint64)
+        offset = (-buf.ctypes.data % 64) >> 3
+        self.__blocks = buf[offset:offset + self.__numBlocks * 4] \
+                        .reshape(self.__numBlocks, 4)
+
+        #build probe kernels specialized for this filter's geometry
+        self.__insertKernel, self.__findKernel, \
+            self.__insertManyKernel, self.__findManyKernel = \
+            _makeKernels(self.__numBlocks, self.__numHashes)
     
   
+    # Computes the two 64 bit base hashes that every probe index is
+    # derived from. Probe i is h1 + i*h2 (Kirsch-Mitzenmacher double
+    # hashing), which behaves like numHashes independent hash functions.
+    # The two hashes use fixed, distinct seeds so neither depends on the
+    # other - the streams can be computed in any order or in parallel.
+    def __hashPair(self, key):
+        if isinstance(key, str): key = key.encode()
+        return (xxh3_64_intdigest(key),
+                xxh3_64_intdigest(key, seed=SEED2))
+
+
+    # Base hashes for a whole batch of keys, as two uint64 arrays.
+    # Since the streams are independent, each one is a single pass over
+    # the batch rather than a pair of dependent calls per key.
+    def __hashMany(self, keys):
+
+        #hoist the hash function and seed into locals - these
+        #comprehensions are the last per-key Python loops in the batch
+        #paths, and a global load per key costs several times what a
+        #local does in CPython
+        digest = xxh3_64_intdigest
+        seed2 = SEED2
+        keys = [k.encode() if isinstance(k, str) else k for k in keys]
+        h1 = np.array([digest(k) for k in keys], dtype=np.uint64)
+        h2 = np.array([digest(k, seed=seed2) for k in keys],
+                      dtype=np.uint64)
+        return h1, h2
+
+
     def insert(self, key):
-        
-        #start seed should be zero
-        seed = 0
-        for i in range(self.__numHashes):
-            
-            #upon hashing, store the result of the hash to be used as
-            #the next seed
-            seed = BH(key, seed)
-            
-            #find what index to use based on the size of the bit vector
-            index = seed%self.__N
-            
-            #if the index isn't already a 1, set it to be 1, and increment
-            #the count of the number of bits we've set
-            if self.__bitVector[index]!=1:
-                self.__bitVector[index]=1
-                self.__numBits+=1
+
+        #hash in Python, then hand the probe loop to the compiled kernel
+        h1, h2 = self.__hashPair(key)
+        self.__insertKernel(self.__blocks, np.uint64(h1), np.uint64(h2))
         
     
+    # Inserts a whole batch of keys at once: only the two base hashes
+    # per key are computed in Python, and the whole probe loop runs as
+    # one fused, GIL-free kernel call over the batch.
+    def insertMany(self, keys):
+
+        n = len(keys)
+        if n == 0: return
+
+        h1, h2 = self.__hashMany(keys)
+
+        #apply the keys in block order - sorting the updates turns a
+        #random walk over the block array into mostly-sequential cache
+        #line accesses that the hardware prefetcher can stay ahead of
+        blk = (h1 >> np.uint64(32)) * np.uint64(self.__numBlocks) \
+              >> np.uint64(32)
+        order = np.argsort(blk)
+        h1, h2 = h1[order], h2[order]
+
+        if n < MIN_PARALLEL or NUM_THREADS < 2 \
+           or self.__numBlocks < NUM_THREADS:
+            self.__insertManyKernel(self.__blocks, h1, h2)
+            return
+
+        #for a large batch, carve the sorted keys at block boundaries
+        #so no two threads ever write the same block - the nogil
+        #kernels then run in parallel with no atomics needed
+        blk = blk[order]
+        edges = np.searchsorted(blk, np.arange(1, NUM_THREADS) *
+                                (self.__numBlocks // NUM_THREADS))
+        bounds = [0] + list(edges) + [n]
+        with ThreadPoolExecutor(NUM_THREADS) as pool:
+            futures = [pool.submit(self.__insertManyKernel, self.__blocks,
+                                   h1[a:b], h2[a:b])
+                       for a, b in zip(bounds, bounds[1:])]
+        for future in futures: future.result()
+
+
+    # Looks up a whole batch of keys at once. Returns a boolean array
+    # where entry k is True if keys[k] might be in the filter. Like
+    # insertMany, the probe loop is one GIL-free kernel call.
+    def findMany(self, keys):
+
+        n = len(keys)
+        if n == 0: return np.zeros(0, dtype=bool)
+
+        h1, h2 = self.__hashMany(keys)
+        out = np.empty(n, dtype=np.bool_)
+
+        if n < MIN_PARALLEL or NUM_THREADS < 2:
+            self.__findManyKernel(self.__blocks, h1, h2, out)
+            return out
+
+        #lookups only read the blocks, so a large batch just splits
+        #into even chunks, one nogil kernel call per thread
+        bounds = [k * n // NUM_THREADS for k in range(NUM_THREADS + 1)]
+        with ThreadPoolExecutor(NUM_THREADS) as pool:
+            futures = [pool.submit(self.__findManyKernel, self.__blocks,
+                                   h1[a:b], h2[a:b], out[a:b])
+                       for a, b in zip(bounds, bounds[1:])]
+        for future in futures: future.result()
+        return out
+
+
     def find(self, key):
-        
-        #start seed should be zero
-        seed = 0
-        for i in range(self.__numHashes):
-            
-            #each time we hash, use the previous hash as the seed - 
-            #this simulates using multiple hash functions
-            seed = BH(key, seed)
-            
-            #if we did not find that the index where we should find this key
-            #was set to 1, tell the client
-            if not self.__bitVector[seed%self.__N]:
-                return False
-        
-        #if we made it here, then we found the key in the Bloom Filter
-        return True
+
+        #hash in Python, then hand the probe loop to the compiled kernel
+        h1, h2 = self.__hashPair(key)
+        return self.__findKernel(self.__blocks, np.uint64(h1),
+                                 np.uint64(h2))
             
        
     def falsePositiveRate(self):
-        
+
         #calculate the false positive rate based on the number of bits
         #that are initialized
-        phi = (self.__N - self.__numBits)/(self.__N)
+        phi = (self.__N - self.numBitsSet())/(self.__N)
         return (1-phi)**self.__numHashes
 
+    # Checkpoints the filter by dumping the bitmap as raw words - no
+    # pickling, and a filter this shape can be reopened with loadMmap.
+    def save(self, path):
+        self.__blocks.tofile(path)
+
+
+    # Reopens a saved filter by memory mapping its bitmap instead of
+    # reading it back in: zero copy, instant startup however large the
+    # filter is, and multiple processes can share the same pages. The
+    # constructor arguments must match the filter that was saved. The
+    # mapping is read only, so the result answers find and findMany
+    # but cannot be inserted into.
+    @classmethod
+    def loadMmap(cls, path, numKeys, numHashes, maxFalsePositive):
+        bf = cls(numKeys, numHashes, maxFalsePositive)
+        bf.__blocks = np.memmap(path, dtype=np.uint64, mode="r") \
+                        .reshape(bf.__numBlocks, 4)
+        return bf
+
+
     def numBitsSet(self):
-        return self.__numBits
+
+        #popcount the whole bitmap on demand - this is only called for
+        #the analytical estimate, and counting all N bits in bulk is far
+        #cheaper than having every insert probe pay a read and a branch
+        #just to keep a running total. bitwise_count compiles down to
+        #the hardware popcount, one 64 bit word at a time, instead of
+        #unpacking the bitmap into one byte per bit and summing
+        return int(np.bitwise_count(self.__blocks).sum())
 
 
 def __main():
@@ -93,33 +271,26 @@ def __main():
     
     # create the Bloom Filter
     BF = BloomFilter(numKeys, numHashes, maxFalse)
-    f = open("wordlist.txt")
-    
-    # read the first numKeys words from the file and insert them 
-    # into the Bloom Filter. Close the input file.
-    for i in range(numKeys):
-        BF.insert(f.readline().strip())
-        
-    f.close()
 
-    print('Estimated False Positive:', BF.falsePositiveRate())
-    
-    f = open("wordlist.txt")
-    
-    missing = 0
+    # map the word list instead of reading it line by line - one
+    # mapping instead of ~300k per-line reads, and the words stay bytes
+    # all the way into the hash. The first numKeys words go into the
+    # filter, the next numKeys should not be found in it
+    with open("wordlist.txt", "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    words = data[:].split()
+
+    # insert the first numKeys words in one batch
+    BF.insertMany(words[:numKeys])
 
-    for i in range(numKeys):
-        if not BF.find(f.readline().strip()): missing+=1
+    print('Estimated False Positive:', BF.falsePositiveRate())
 
+    # every inserted word should be found again
+    missing = int((~BF.findMany(words[:numKeys])).sum())
     print("Missing", missing, "words")
-    
 
-    accidentallyFound = 0
-    for i in range(numKeys):
-        if BF.find(f.readline().strip()): accidentallyFound+=1
-    
-    f.close()
-    
+    # any of the next numKeys words that turn up is a false positive
+    accidentallyFound = int(BF.findMany(words[numKeys:2*numKeys]).sum())
     print('Percent False Positive:', accidentallyFound/numKeys)
     
 if __name__ == '__main__':